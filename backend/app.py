@@ -2,18 +2,21 @@ import io
 import os
 import re
 import json
+import time
 import shutil
 import tempfile
 import subprocess
+from datetime import datetime
 from pathlib import Path
 
-import numpy as np
-import pandas as pd
-from scipy.stats import chi2
-
 from flask import Flask, request, jsonify, send_file, Blueprint
 from flask_cors import CORS
 
+from modes import ModeRegistry, fit_params
+
+# pandas/numpy and the ellipse engine are imported where they are used so that
+# `import app` stays cheap; warm_up() loads them before gunicorn forks workers.
+
 
 app = Flask(__name__)
 CORS(app)
@@ -27,32 +30,78 @@ R_FILE    = Path("prediction/1633_NMDS.R").resolve()
 OUT_DIR   = Path("prediction/output").resolve()
 DATA_BASE = Path("prediction/data").resolve()
 
-# Available analysis modes
-AVAILABLE_MODES = ["1633_pfas", "diagnostic_chemicals"]
 DEFAULT_MODE = "1633_pfas"
 
-# --- helpers ---
-def _get_mode_paths(mode):
-    """Get file paths for a given mode using consistent folder structure."""
-    if mode not in AVAILABLE_MODES:
-        raise ValueError(f"Invalid mode: {mode}. Available: {AVAILABLE_MODES}")
-    
-    mode_dir = DATA_BASE / mode
-    train_dir = mode_dir / "train"
-    
-    # Find the first CSV file in train directory
-    train_csvs = list(train_dir.glob("*.csv"))
-    if not train_csvs:
-        raise FileNotFoundError(f"No training CSV found in {train_dir}")
-    
-    return {
-        "train_csv": train_csvs[0],
-        "demo_dir": mode_dir / "test",
-        "base_nmds": mode_dir / "base_nmds.json",
-        "template": mode_dir / "template.csv"
-    }
+# Analysis modes come from per-mode manifests (see modes.py). The registry is
+# loaded by warm_up() in the gunicorn master (preload_app) and shared with
+# workers copy-on-write; each worker then watches for new/regenerated modes.
+registry = ModeRegistry(DATA_BASE)
+_STATE = {"warm": False, "r_available": False, "r_error": None,
+          "warmup_seconds": None}
 
-def _run_rscript(train_csv, new_csv, out_dir, save_plots=False):
+# --- helpers ---
+def _get_mode(mode):
+    """Registry entry for a mode (loaded on first use if warm_up() has not run)."""
+    if not registry.loaded:
+        registry.reload()
+    return registry.get(mode)
+
+def _prime_ellipses(reg):
+    """Populate the ellipse memo for every base ordination in the registry."""
+    import pandas as pd
+    from ellipses import fit_ellipses
+
+    for mode in reg.names():
+        base = reg.get(mode)["base_nmds"]
+        if base and base.get("scores"):
+            fit_ellipses(pd.DataFrame(base["scores"]))
+
+def _r_required_packages():
+    """Packages 1633_NMDS.R hard-requires: its unconditional library() calls.
+
+    Read from the script itself so the readiness probe cannot drift from it;
+    optional packages loaded behind requireNamespace() are not matched.
+    """
+    text = R_FILE.read_text(encoding="utf-8")
+    return re.findall(r"^\s*library\(\s*([A-Za-z0-9.]+)\s*\)", text, flags=re.M)
+
+def _check_r():
+    """Verify Rscript runs and the packages 1633_NMDS.R needs are installed."""
+    rscript = shutil.which("Rscript")
+    if not rscript:
+        return False, "Rscript not found on PATH"
+    try:
+        packages = _r_required_packages()
+    except OSError as e:
+        return False, f"Cannot read {R_FILE}: {e}"
+    loads = "; ".join(f"library({p})" for p in packages)
+    probe = f"suppressPackageStartupMessages({{{loads}}})"
+    try:
+        cp = subprocess.run([rscript, "--vanilla", "-e", probe],
+                            text=True, capture_output=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return False, str(e)
+    if cp.returncode != 0:
+        return False, cp.stderr.strip()[-2000:] or f"exit code {cp.returncode}"
+    return True, None
+
+def warm_up():
+    """Load everything a first request would otherwise pay for.
+
+    Loads the mode registry (manifests, base NMDS, templates), imports
+    pandas/numpy, primes the ellipse memo for each base ordination and checks
+    R. Meant to run once in the gunicorn master (see gunicorn.conf.py).
+    """
+    t0 = time.perf_counter()
+    registry.reload()
+    _prime_ellipses(registry)
+
+    r_ok, r_err = _check_r()
+    _STATE.update(warm=True, r_available=r_ok, r_error=r_err,
+                  warmup_seconds=round(time.perf_counter() - t0, 3))
+    return _STATE
+
+def _run_rscript(train_csv, new_csv, out_dir, save_plots=False, fit=None):
     rscript = shutil.which("Rscript")
     if not rscript:
         raise RuntimeError("Rscript not found on PATH. Install R or add R\\bin to PATH.")
@@ -66,6 +115,7 @@ def _run_rscript(train_csv, new_csv, out_dir, save_plots=False):
         str(train_csv), str(new_csv), str(out_dir),
         "save" if save_plots else "nosave",
         "0",
+        *(str(v) for v in (fit or fit_params()).values()),
     ]
     cp = subprocess.run(args, text=True, capture_output=True)
 
@@ -88,45 +138,24 @@ def _run_rscript(train_csv, new_csv, out_dir, save_plots=False):
     return json.loads(m.group(0))
 
 
-def _ellipse_params(scores_df: pd.DataFrame):
-    # returns {group: {cx, cy, width, height, angle}}
-    ell = {}
-    df = scores_df.copy()
-    df["Group"] = df["Group"].astype(str)
-    for g, sub in df.groupby("Group"):
-        xy = sub[["NMDS1", "NMDS2"]].to_numpy()
-        if xy.shape[0] < 3:
-            continue
-        mu = xy.mean(axis=0)
-        cov = np.cov(xy, rowvar=False)
-        vals, vecs = np.linalg.eigh(cov)
-        order = vals.argsort()[::-1]
-        vals, vecs = vals[order], vecs[:, order]
-        r2 = chi2.ppf(0.95, df=2)
-        w, h = 2 * np.sqrt(vals * r2)  # width/height for 95% ellipse
-        ang = float(np.degrees(np.arctan2(*vecs[:, 0][::-1])))
-        ell[g] = {
-            "cx": float(mu[0]),
-            "cy": float(mu[1]),
-            "width": float(w),
-            "height": float(h),
-            "angle": ang,
-        }
-    return ell
-
 # --- core ---
 def _process_csv(new_csv_path: Path, mode=DEFAULT_MODE):
-    paths = _get_mode_paths(mode)
+    import pandas as pd
+    from ellipses import fit_ellipses
+
+    entry = _get_mode(mode)
+    paths = entry["paths"]
     
     df = pd.read_csv(new_csv_path)
     preview = df.head(5).to_dict(orient='records')
     columns = list(df.columns)
 
-    payload = _run_rscript(paths["train_csv"], new_csv_path, OUT_DIR, save_plots=False)
+    payload = _run_rscript(paths["train_csv"], new_csv_path, OUT_DIR, save_plots=False,
+                           fit=fit_params(entry["manifest"]))
 
     scores_df = pd.DataFrame(payload["scores"])      # Sample, Group, NMDS1, NMDS2
     new_df    = pd.DataFrame(payload["new_points"])  # Sample, NMDS1, NMDS2
-    ell       = _ellipse_params(scores_df)
+    ell       = fit_ellipses(scores_df)
 
     return {
         "preview": preview,
@@ -135,7 +164,8 @@ def _process_csv(new_csv_path: Path, mode=DEFAULT_MODE):
             "stress": payload.get("stress"),
             "scores": payload.get("scores", []),
             "new_points": payload.get("new_points", []),
-            "ellipses": ell,
+            "ellipses": ell.params(),
+            "membership": ell.membership(new_df),
         }
     }
 
@@ -143,12 +173,7 @@ def _process_csv(new_csv_path: Path, mode=DEFAULT_MODE):
 def demo_options():
     mode = request.args.get('mode', DEFAULT_MODE)
     try:
-        paths = _get_mode_paths(mode)
-        demo_dir = paths["demo_dir"]
-        if not demo_dir.exists():
-            return jsonify({"options": []})
-        files = sorted([p.name for p in demo_dir.glob("*.csv") if p.is_file()])
-        return jsonify({"options": files})
+        return jsonify({"options": _get_mode(mode)["demo_files"]})
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
@@ -159,14 +184,12 @@ def demo_run():
     mode = data.get("mode", DEFAULT_MODE)
     
     try:
-        paths = _get_mode_paths(mode)
-        demo_dir = paths["demo_dir"]
+        entry = _get_mode(mode)
         # allow only files we advertised
-        allowed = {p.name for p in demo_dir.glob("*.csv")}
-        if name not in allowed:
+        if name not in entry["demo_files"]:
             return jsonify({"error": "Invalid demo file"}), 400
 
-        result = _process_csv(demo_dir / name, mode)
+        result = _process_csv(entry["paths"]["demo_dir"] / name, mode)
         return jsonify(result)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
@@ -216,12 +239,15 @@ def download_results():
     csv_rows = []
     
     # Header with metadata (plain text, no #)
-    mode_name = "1633 PFAS Compounds" if mode == "1633_pfas" else "Diagnostic Target & Suspect Chemicals"
+    try:
+        mode_name = _get_mode(mode)["title"]
+    except ValueError:
+        mode_name = mode
     stress_str = f"{stress:.4f}" if stress is not None else "N/A"
     csv_rows.extend([
         "PFAS NMDS Analysis Results",
         f"Analysis Mode: {mode_name}",
-        f"Generated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
         f"Stress: {stress_str}",
         f"New samples: {len(new_points)}",
         "",  # Empty line
@@ -249,7 +275,7 @@ def download_results():
     csv_content = "\n".join(csv_rows)
     
     # Generate filename
-    timestamp = pd.Timestamp.now().strftime('%Y-%m-%d')
+    timestamp = datetime.now().strftime('%Y-%m-%d')
     filename = f"{mode}_nmds_results_{timestamp}.csv"
     
     return send_file(
@@ -264,11 +290,15 @@ def download_results():
 def download_template():
     mode = request.args.get('mode', DEFAULT_MODE)
     try:
-        paths = _get_mode_paths(mode)
-        template_path = paths["template"]
-        if not template_path.exists():
+        entry = _get_mode(mode)
+        if entry["template"] is None:
             return jsonify({"error": f"Template not found for mode: {mode}"}), 404
-        return send_file(template_path, as_attachment=True)
+        return send_file(
+            io.BytesIO(entry["template"]),
+            mimetype='text/csv',
+            as_attachment=True,
+            download_name=entry["paths"]["template"].name
+        )
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
@@ -278,14 +308,10 @@ def get_base_nmds():
     mode = request.args.get('mode', DEFAULT_MODE)
     
     try:
-        paths = _get_mode_paths(mode)
-        base_data_path = paths["base_nmds"]
+        base_data = _get_mode(mode)["base_nmds"]
         
-        if not base_data_path.exists():
-            return jsonify({"error": f"Base NMDS data not found for mode: {mode}. Run generate_base_nmds.py first."}), 404
-        
-        with open(base_data_path, 'r') as f:
-            base_data = json.load(f)
+        if base_data is None:
+            return jsonify({"error": f"Base NMDS data not found for mode: {mode}. Run data_generation_pipeline.py first."}), 404
         
         # Return in the same format as the regular processing
         return jsonify({
@@ -298,6 +324,18 @@ def get_base_nmds():
     except Exception as e:
         return jsonify({"error": f"Failed to load base NMDS data: {e}"}), 500
 
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """Readiness probe: 200 only once warm-up finished and R is usable."""
+    ok = _STATE["warm"] and _STATE["r_available"] and not registry.errors
+    return jsonify({
+        "ready": ok,
+        **_STATE,
+        "modes": registry.names(),
+        "errors": registry.errors,
+        "pending": registry.pending,
+    }), (200 if ok else 503)
+
 # --- flask stuff ---
 
 # Serve static files
@@ -310,4 +348,6 @@ def static_proxy(path):
     return send_file(f'static/{path}')
 
 if __name__ == '__main__':
+    warm_up()
+    registry.start_watching(on_change=_prime_ellipses)
     app.run(debug=True)
\ No newline at end of file
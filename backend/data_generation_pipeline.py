@@ -6,6 +6,8 @@ This script provides a complete pipeline to generate all necessary data files fo
 1. Source average files for demos
 2. Template CSV files 
 3. Base NMDS data for landing page
+4. manifest.json (training file, feature schema, fit parameters, artifact
+   hashes) that registers the mode with the running app
 
 Usage:
     python data_generation_pipeline.py --mode 1633_pfas
@@ -17,7 +19,9 @@ import json
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from app import _run_rscript, _ellipse_params
+from app import _run_rscript
+from ellipses import fit_ellipses, REPORT_LEVELS
+import modes
 import argparse
 import sys
 
@@ -26,12 +30,7 @@ DATA_BASE = Path("prediction/data")
 
 def discover_modes():
     """Auto-discover available modes by scanning data directory."""
-    modes = []
-    if DATA_BASE.exists():
-        for folder in DATA_BASE.iterdir():
-            if folder.is_dir() and (folder / "train").exists():
-                modes.append(folder.name)
-    return sorted(modes)
+    return modes.discover_modes(DATA_BASE)
 
 def get_mode_paths(mode):
     """Get file paths for a given mode."""
@@ -40,19 +39,16 @@ def get_mode_paths(mode):
         raise ValueError(f"Invalid mode: {mode}. Available: {available_modes}")
     
     mode_dir = DATA_BASE / mode
-    train_dir = mode_dir / "train"
-    
-    # Find the first CSV file in train directory
-    train_csvs = list(train_dir.glob("*.csv"))
-    if not train_csvs:
-        raise FileNotFoundError(f"No training CSV found in {train_dir}")
-    
-    return {
-        "train_csv": train_csvs[0],
-        "demo_dir": mode_dir / "test",
-        "base_nmds": mode_dir / "base_nmds.json",
-        "template": mode_dir / "template.csv"
-    }
+    return modes.mode_paths(mode_dir, modes.find_train_csv(mode_dir))
+
+def feature_columns(df):
+    """Numeric feature columns (same selection as load_data in 1633_NMDS.R)."""
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    if 'Sample' in numeric_cols:
+        numeric_cols.remove('Sample')
+    if 'Grouping' in numeric_cols:
+        numeric_cols.remove('Grouping')
+    return numeric_cols
 
 def generate_source_averages(mode):
     """
@@ -72,11 +68,7 @@ def generate_source_averages(mode):
     df = pd.read_csv(train_csv)
     
     # Get numeric columns (exclude Sample and Grouping)
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-    if 'Sample' in numeric_cols:
-        numeric_cols.remove('Sample')
-    if 'Grouping' in numeric_cols:
-        numeric_cols.remove('Grouping')
+    numeric_cols = feature_columns(df)
     
     # Calculate averages by group
     source_averages = df.groupby('Grouping')[numeric_cols].mean().reset_index()
@@ -111,11 +103,7 @@ def generate_template(mode):
     df = pd.read_csv(train_csv)
     
     # Get numeric columns (chemical features)
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-    if 'Sample' in numeric_cols:
-        numeric_cols.remove('Sample')
-    if 'Grouping' in numeric_cols:
-        numeric_cols.remove('Grouping')
+    numeric_cols = feature_columns(df)
     
     # Create template with just column headers (no example data)
     cols = ['Sample', 'Grouping'] + numeric_cols
@@ -141,14 +129,17 @@ def generate_base_nmds(mode):
     out_dir = Path("prediction/output")
     
     # Use training data as both training and "new" data to get base scores_df
-    payload = _run_rscript(train_csv, train_csv, out_dir, save_plots=False)
+    fit = modes.fit_params(modes.read_manifest(DATA_BASE / mode))
+    payload = _run_rscript(train_csv, train_csv, out_dir, save_plots=False, fit=fit)
     
     # Extract scores_df (this contains all the training data points)
     scores_df = pd.DataFrame(payload["scores"])
     print(f"Generated scores_df with {len(scores_df)} points")
     
-    # Generate ellipses
-    ellipses = _ellipse_params(scores_df)
+    # Generate ellipses: 95% NMDS1 vs NMDS2 for the plot, plus every axis
+    # pair at every reported level from the same batched pass
+    ell_set = fit_ellipses(scores_df, levels=REPORT_LEVELS)
+    ellipses = ell_set.params()
     print(f"Generated ellipses for {len(ellipses)} groups")
     
     # Create base data structure (without new_points since this is the base)
@@ -156,6 +147,7 @@ def generate_base_nmds(mode):
         "stress": payload.get("stress"),
         "scores": payload.get("scores", []),
         "ellipses": ellipses,
+        "ellipse_sets": ell_set.to_dict(),  # "NMDS1-NMDS2" -> "0.95" -> group
         "new_points": []  # Empty for base plot
     }
     
@@ -170,7 +162,23 @@ def generate_base_nmds(mode):
     
     return base_nmds_path
 
-def run_full_pipeline(mode):
+def generate_manifest(mode, title=None):
+    """
+    Write manifest.json last, once every artifact exists, so the app's registry
+    only ever picks up a complete mode.
+    """
+    print(f"Generating manifest for {mode}...")
+    
+    paths = get_mode_paths(mode)
+    features = feature_columns(pd.read_csv(paths["train_csv"]))
+    manifest_path = modes.write_manifest(DATA_BASE / mode, features, title=title)
+    
+    print(f"[OK] Manifest saved to: {manifest_path}")
+    print(f"  Contains {len(features)} features")
+    
+    return manifest_path
+
+def run_full_pipeline(mode, title=None):
     """
     Run the complete data generation pipeline for a mode.
     """
@@ -188,6 +196,9 @@ def run_full_pipeline(mode):
         # Step 3: Generate base NMDS data
         generate_base_nmds(mode)
         
+        # Step 4: Register the mode (running apps hot-reload it)
+        generate_manifest(mode, title=title)
+        
         print(f"\n[SUCCESS] Pipeline completed successfully for {mode}!")
         
     except Exception as e:
@@ -259,14 +270,17 @@ def main():
     parser = argparse.ArgumentParser(description='Generate data files for PFAS source tracking modes')
     parser.add_argument('--mode', choices=available_modes, help='Generate data for specific mode')
     parser.add_argument('--all', action='store_true', help='Generate data for all modes')
-    parser.add_argument('--step', choices=['averages', 'template', 'nmds'], 
+    parser.add_argument('--step', choices=['averages', 'template', 'nmds', 'manifest'], 
                        help='Run only specific step')
+    parser.add_argument('--title', help='Display name stored in the mode manifest')
     
     args = parser.parse_args()
     
     if not args.mode and not args.all:
         parser.print_help()
         sys.exit(1)
+    if args.title and (args.all or not args.mode):
+        parser.error("--title sets one mode's display name; use it with --mode, not --all")
     
     # Determine which modes to process
     modes_to_process = available_modes if args.all else [args.mode]
@@ -289,9 +303,12 @@ def main():
                     generate_template(mode)
                 elif args.step == 'nmds':
                     generate_base_nmds(mode)
+                
+                # Re-hash after any regenerated artifact so the mode stays registered
+                generate_manifest(mode, title=args.title)
             else:
                 # Run full pipeline
-                if run_full_pipeline(mode):
+                if run_full_pipeline(mode, title=args.title):
                     success_count += 1
                     
         except Exception as e:
@@ -0,0 +1,193 @@
+"""
+Confidence ellipses for NMDS group scores.
+
+All groups, all axis pairs (NMDS1 vs NMDS2, NMDS1 vs NMDS3, ...) and all
+requested confidence levels are computed in one batched NumPy pass over
+stacked arrays. Results are memoized per base ordination, keyed by a hash of
+its scores, so repeated requests against the same base NMDS skip the math.
+
+Degenerate groups (e.g. duplicated source-average samples, or points on a
+line) have zero variance along one or both ellipse axes. Their ellipse is a
+segment or a single point, so membership only accepts a new point whose
+offset along every zero-variance axis is ~0; it never falls back to a
+pseudo-inverse, which would treat those axes as unbounded.
+"""
+
+import hashlib
+import re
+from itertools import combinations
+
+import numpy as np
+
+DEFAULT_LEVELS = (0.95,)
+REPORT_LEVELS = (0.68, 0.95, 0.99)  # levels precomputed into base_nmds.json
+MIN_POINTS = 3  # same cutoff as the R side (dplyr::filter(n() >= 3))
+DEGENERATE_RTOL = 1e-10  # eigenvalue <= rtol * largest (or ~0) means no spread
+OFFSET_ATOL = 1e-9       # allowed offset along a zero-variance axis
+
+_AXIS_RE = re.compile(r"^NMDS(\d+)$")
+_CACHE = {}
+_CACHE_MAX = 32
+
+
+# --- helpers ---
+def chi2_radius(levels):
+    """Squared Mahalanobis radius for 2-D confidence levels.
+
+    For two degrees of freedom the chi-square quantile has the closed form
+    -2 * ln(1 - p), identical to chi2.ppf(p, df=2).
+    """
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))
+    if np.any((levels <= 0) | (levels >= 1)):
+        raise ValueError(f"Confidence levels must be in (0, 1): {levels.tolist()}")
+    return -2.0 * np.log1p(-levels)
+
+
+def _axis_columns(scores_df):
+    axes = [c for c in scores_df.columns if _AXIS_RE.match(str(c))]
+    axes.sort(key=lambda c: int(_AXIS_RE.match(c).group(1)))
+    if len(axes) < 2:
+        raise ValueError(f"Need at least two NMDS axes, got: {axes}")
+    return axes
+
+
+def _fingerprint(scores_df, axes):
+    h = hashlib.sha1()
+    h.update(",".join(axes).encode())
+    h.update(np.ascontiguousarray(scores_df[axes].to_numpy(dtype=float)).tobytes())
+    h.update("\x1f".join(scores_df["Group"].astype(str)).encode())
+    return h.hexdigest()
+
+
+class EllipseSet:
+    """Batched ellipse geometry for one base ordination.
+
+    Arrays are indexed [group, pair, level, ...]:
+      centers (G, P, 2), covs (G, P, 2, 2), widths/heights/angles (G, P, L).
+    """
+
+    def __init__(self, groups, axes, pairs, levels, centers, covs):
+        self.groups = groups
+        self.axes = axes
+        self.pairs = pairs
+        self.levels = levels
+        self.centers = centers
+        self.covs = covs
+        self.r2 = chi2_radius(levels)
+
+        vals, vecs = np.linalg.eigh(covs)               # ascending, batched
+        vals = np.clip(vals[..., ::-1], 0.0, None)       # major axis first
+        major = vecs[..., :, -1]                         # (G, P, 2)
+        axes_len = 2 * np.sqrt(vals[:, :, None, :] * self.r2[None, None, :, None])
+        self.widths = axes_len[..., 0]
+        self.heights = axes_len[..., 1]
+        ang = np.degrees(np.arctan2(major[..., 1], major[..., 0]))
+        self.angles = np.broadcast_to(ang[:, :, None], self.widths.shape)
+
+        # eigenbasis for membership; flag axes without spread explicitly
+        self._evals = vals
+        self._evecs = vecs[..., ::-1]
+        self._flat = vals <= np.maximum(DEGENERATE_RTOL * vals[..., :1], np.finfo(float).tiny)
+
+    def params(self, pair=("NMDS1", "NMDS2"), level=0.95):
+        """Return {group: {cx, cy, width, height, angle}} for one pair/level."""
+        p = self.pairs.index(tuple(pair))
+        l = self._level_index(level)
+        return {
+            g: {
+                "cx": float(self.centers[i, p, 0]),
+                "cy": float(self.centers[i, p, 1]),
+                "width": float(self.widths[i, p, l]),
+                "height": float(self.heights[i, p, l]),
+                "angle": float(self.angles[i, p, l]),
+            }
+            for i, g in enumerate(self.groups)
+        }
+
+    def to_dict(self):
+        """Every pair and level, keyed "NMDS1-NMDS2" -> "0.95" -> group."""
+        return {
+            f"{a}-{b}": {f"{lvl:g}": self.params((a, b), lvl) for lvl in self.levels}
+            for a, b in self.pairs
+        }
+
+    def contains(self, points):
+        """Vectorized point-in-ellipse test.
+
+        points: (N, k) array with columns in self.axes order.
+        Returns a bool array (N, G, P, L).
+        """
+        pts = np.asarray(points, dtype=float)
+        idx = np.array([[self.axes.index(a), self.axes.index(b)] for a, b in self.pairs])
+        xy = pts[:, idx]                                         # (N, P, 2)
+        d = xy[:, None, :, :] - self.centers[None, :, :, :]      # (N, G, P, 2)
+        z = np.einsum("ngpi,gpij->ngpj", d, self._evecs)         # offsets along axes
+        safe = np.where(self._flat, 1.0, self._evals)
+        d2 = np.where(self._flat, 0.0, z * z / safe).sum(axis=-1)
+        off_flat = (self._flat & (np.abs(z) > OFFSET_ATOL)).any(axis=-1)
+        return (d2[..., None] <= self.r2) & ~off_flat[..., None]
+
+    def membership(self, new_df, pair=("NMDS1", "NMDS2"), level=0.95):
+        """Return {sample: [groups whose ellipse contains it]} for one pair/level."""
+        if new_df is None or len(new_df) == 0:
+            return {}
+        inside = self.contains(new_df[self.axes].to_numpy(dtype=float))
+        p = self.pairs.index(tuple(pair))
+        l = self._level_index(level)
+        samples = new_df["Sample"].astype(str) if "Sample" in new_df else new_df.index.astype(str)
+        return {
+            s: [g for g, hit in zip(self.groups, row) if hit]
+            for s, row in zip(samples, inside[:, :, p, l])
+        }
+
+    def _level_index(self, level):
+        hits = np.flatnonzero(np.isclose(self.levels, level))
+        if not hits.size:
+            raise ValueError(f"Level {level} not computed. Available: {list(self.levels)}")
+        return int(hits[0])
+
+
+def _fit(scores_df, axes, levels, min_points):
+    groups_all = scores_df["Group"].astype(str).to_numpy()
+    X = scores_df[axes].to_numpy(dtype=float)
+
+    names, codes, counts = np.unique(groups_all, return_inverse=True, return_counts=True)
+    keep = counts >= min_points
+    X, codes = X[keep[codes]], codes[keep[codes]]
+    remap = np.cumsum(keep) - 1
+    codes, counts, names = remap[codes], counts[keep], names[keep]
+    G, k = len(names), len(axes)
+
+    # group means and full k x k covariances, accumulated in one pass
+    sums = np.zeros((G, k))
+    np.add.at(sums, codes, X)
+    means = sums / counts[:, None]
+    centered = X - means[codes]
+    covs = np.zeros((G, k, k))
+    np.add.at(covs, codes, centered[:, :, None] * centered[:, None, :])
+    covs /= (counts - 1)[:, None, None]
+
+    # every axis pair is a 2x2 sub-block of the full covariance
+    pair_idx = list(combinations(range(k), 2))
+    ii = np.array(pair_idx)                                  # (P, 2)
+    pair_means = means[:, ii]                                # (G, P, 2)
+    pair_covs = covs[:, ii[:, :, None], ii[:, None, :]]      # (G, P, 2, 2)
+    pairs = [(axes[i], axes[j]) for i, j in pair_idx]
+
+    return EllipseSet([str(n) for n in names], axes, pairs, tuple(levels),
+                      pair_means, pair_covs)
+
+
+def fit_ellipses(scores_df, levels=DEFAULT_LEVELS, min_points=MIN_POINTS):
+    """Batched ellipses for every group, axis pair and level (memoized)."""
+    axes = _axis_columns(scores_df)
+    levels = tuple(float(l) for l in levels)
+    key = (_fingerprint(scores_df, axes), levels, min_points)
+    ell = _CACHE.get(key)
+    if ell is None:
+        ell = _fit(scores_df, axes, levels, min_points)
+        if len(_CACHE) >= _CACHE_MAX:
+            _CACHE.pop(next(iter(_CACHE)))
+        _CACHE[key] = ell
+    return ell
+
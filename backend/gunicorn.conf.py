@@ -0,0 +1,31 @@
+# Gunicorn settings for the PFAS backend.
+#
+# preload_app imports app.py once in the master; when_ready then runs the
+# warm-up there, before any worker is forked, so mode paths, base NMDS data,
+# templates, pandas/numpy and the ellipse memo are shared copy-on-write and
+# no user request pays the cold-start cost.
+import gc
+
+bind = "0.0.0.0:8080"
+preload_app = True
+
+
+def when_ready(server):
+    import app
+
+    state = app.warm_up()
+    server.log.info("Warm-up finished in %ss (R available: %s)",
+                    state["warmup_seconds"], state["r_available"])
+    if state["r_error"]:
+        server.log.warning("R check failed: %s", state["r_error"])
+    for mode, err in app.registry.errors.items():
+        server.log.warning("Mode %s failed to load: %s", mode, err)
+    # keep the preloaded objects out of later GC passes so their pages stay shared
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # watcher threads do not survive fork, so each worker starts its own
+    import app
+
+    app.registry.start_watching(on_change=app._prime_ellipses)
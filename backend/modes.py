@@ -0,0 +1,292 @@
+"""
+Analysis-mode registry shared by the Flask app and the data pipeline.
+
+Each mode lives in prediction/data/<mode>/ and is described by a
+manifest.json written by data_generation_pipeline.py:
+
+    {
+      "mode": "1633_pfas",
+      "title": "1633 PFAS Compounds",
+      "train_file": "train/<file>.csv",
+      "features": [...],              # feature columns fed to the NMDS
+      "fit": {...},                   # NMDS fit parameters passed to the R script
+      "demo_files": [...],            # CSVs under test/
+      "artifacts": {"<relpath>": "<sha256>", ...},
+      "generated": "<ISO timestamp>"
+    }
+
+The app keeps one immutable snapshot of all modes in memory and swaps it in a
+single assignment when a manifest changes, so requests never touch the
+filesystem to resolve a mode and a new panel rolls out without restarts.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+WATCHER_ERROR_KEY = "<watcher>"
+RETRY_DELAY = 30.0  # seconds before the single retry of a mode that failed to load
+
+log = logging.getLogger(__name__)
+
+# Default NMDS fit parameters, in the order 1633_NMDS.R takes them on its
+# command line after [scores_limit]. A mode's manifest "fit" block overrides
+# them and is what _run_rscript passes to R, so the manifest describes the
+# model that is actually served.
+FIT_PARAMS = {
+    "k": 2,
+    "seed": 42,
+    "trymax": 500,
+    "maxit": 1000,
+}
+
+
+# --- helpers ---
+def discover_modes(data_base):
+    """Mode folders under data_base: anything with train/ data or a manifest."""
+    data_base = Path(data_base)
+    if not data_base.exists():
+        return []
+    return sorted(
+        p.name for p in data_base.iterdir()
+        if p.is_dir() and ((p / "train").exists() or (p / MANIFEST_NAME).exists())
+    )
+
+
+def find_train_csv(mode_dir):
+    """The single training CSV for a mode; ambiguity is an error, not a guess."""
+    train_dir = Path(mode_dir) / "train"
+    train_csvs = sorted(train_dir.glob("*.csv"))
+    if not train_csvs:
+        raise FileNotFoundError(f"No training CSV found in {train_dir}")
+    if len(train_csvs) > 1:
+        names = ", ".join(p.name for p in train_csvs)
+        raise ValueError(f"Multiple training CSVs in {train_dir}: {names}. Keep exactly one.")
+    return train_csvs[0]
+
+
+def file_sha256(path):
+    """Content hash with CRLF folded to LF, so Windows checkouts still match."""
+    data = Path(path).read_bytes().replace(b"\r\n", b"\n")
+    return hashlib.sha256(data).hexdigest()
+
+
+def mode_paths(mode_dir, train_csv):
+    """Standard artifact locations for a mode folder."""
+    mode_dir = Path(mode_dir)
+    return {
+        "train_csv": Path(train_csv),
+        "demo_dir": mode_dir / "test",
+        "base_nmds": mode_dir / "base_nmds.json",
+        "template": mode_dir / "template.csv",
+        "manifest": mode_dir / MANIFEST_NAME,
+    }
+
+
+def fit_params(manifest=None):
+    """Fit parameters for a mode: manifest overrides on FIT_PARAMS, CLI order."""
+    fit = (manifest or {}).get("fit") or {}
+    return {name: int(fit.get(name, default)) for name, default in FIT_PARAMS.items()}
+
+
+def read_manifest(mode_dir):
+    path = Path(mode_dir) / MANIFEST_NAME
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(mode_dir, features, title=None):
+    """Hash the current artifacts of a mode and (re)write its manifest.
+
+    The file is replaced atomically so a watching app never reads half of it.
+    """
+    mode_dir = Path(mode_dir)
+    previous = read_manifest(mode_dir) or {}
+    paths = mode_paths(mode_dir, find_train_csv(mode_dir))
+
+    demo_files = sorted(p.name for p in paths["demo_dir"].glob("*.csv") if p.is_file())
+    tracked = [paths["train_csv"], paths["base_nmds"], paths["template"]]
+    tracked += [paths["demo_dir"] / name for name in demo_files]
+
+    manifest = {
+        "mode": mode_dir.name,
+        "title": title or previous.get("title") or mode_dir.name,
+        "train_file": paths["train_csv"].relative_to(mode_dir).as_posix(),
+        "features": list(features),
+        "fit": fit_params(previous),
+        "demo_files": demo_files,
+        "artifacts": {
+            p.relative_to(mode_dir).as_posix(): file_sha256(p) for p in tracked if p.exists()
+        },
+        "generated": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    tmp = paths["manifest"].with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, paths["manifest"])
+    return paths["manifest"]
+
+
+def load_mode(mode_dir):
+    """Build the in-memory entry for one mode from its manifest.
+
+    Verifies artifact hashes and loads the small static payloads (base NMDS,
+    template) so requests can be served from memory.
+    """
+    mode_dir = Path(mode_dir)
+    manifest = read_manifest(mode_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in {mode_dir}")
+
+    for rel, digest in manifest.get("artifacts", {}).items():
+        path = mode_dir / rel
+        if not path.exists():
+            raise FileNotFoundError(f"Artifact listed in manifest is missing: {path}")
+        if file_sha256(path) != digest:
+            raise ValueError(f"Artifact changed since manifest was written: {path}. "
+                             f"Re-run data_generation_pipeline.py for {mode_dir.name}.")
+
+    paths = mode_paths(mode_dir, mode_dir / manifest["train_file"])
+    base_nmds = None
+    if paths["base_nmds"].exists():
+        with open(paths["base_nmds"], "r") as f:
+            base_nmds = json.load(f)
+    template = paths["template"].read_bytes() if paths["template"].exists() else None
+
+    return {
+        "name": mode_dir.name,
+        "title": manifest.get("title", mode_dir.name),
+        "manifest": manifest,
+        "paths": paths,
+        "demo_files": list(manifest.get("demo_files", [])),
+        "base_nmds": base_nmds,
+        "template": template,
+    }
+
+
+class ModeRegistry:
+    """In-memory snapshot of all modes, hot-swapped when manifests change."""
+
+    def __init__(self, data_base):
+        self.data_base = Path(data_base)
+        self._modes = {}      # replaced wholesale, never mutated in place
+        self.errors = {}
+        self.pending = []
+        self._signature = None
+        self._failed = {}     # name -> ((mtime, size), retry_at or None)
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    # --- lookup (request path: memory only) ---
+    @property
+    def loaded(self):
+        return self._signature is not None
+
+    def names(self):
+        return sorted(self._modes)
+
+    def get(self, mode):
+        entry = self._modes.get(mode)
+        if entry is None:
+            raise ValueError(f"Invalid mode: {mode}. Available: {self.names()}")
+        return entry
+
+    # --- loading ---
+    def _scan_signature(self):
+        sig = []
+        for name in discover_modes(self.data_base):
+            try:
+                st = (self.data_base / name / MANIFEST_NAME).stat()
+                sig.append((name, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                sig.append((name, None, None))
+        return tuple(sig)
+
+    def reload(self):
+        """Rebuild the snapshot and swap it in; returns True if it changed.
+
+        Modes whose manifest is unchanged keep their loaded entry. A mode that
+        fails to load keeps its previous entry (if any) so a half-regenerated
+        folder never takes a working panel offline. It is retried when its
+        manifest changes, plus once after RETRY_DELAY for transient errors,
+        so a permanent failure does not re-hash its files on every poll.
+        """
+        with self._lock:
+            now = time.monotonic()
+            signature = self._scan_signature()
+            retry_due = any(at is not None and now >= at for _, at in self._failed.values())
+            if signature == self._signature and not retry_due:
+                return False
+
+            old = self._modes
+            seen = {name: (mtime, size) for name, mtime, size in self._signature or ()}
+            modes, errors, pending, failed = {}, {}, [], {}
+            for name, mtime, size in signature:
+                stat = (mtime, size)
+                if mtime is None:
+                    pending.append(name)
+                    continue
+                prev_fail = self._failed.get(name)
+                if prev_fail is not None and prev_fail[0] == stat:
+                    retry_at = prev_fail[1]
+                    if retry_at is None or now < retry_at:
+                        # same broken manifest, no retry due: keep the last state
+                        failed[name] = prev_fail
+                        errors[name] = self.errors.get(name, "failed to load")
+                        if name in old:
+                            modes[name] = old[name]
+                        continue
+                elif seen.get(name) == stat and name in old:
+                    modes[name] = old[name]
+                    continue
+                try:
+                    modes[name] = load_mode(self.data_base / name)
+                except Exception as e:
+                    errors[name] = str(e)
+                    # first failure for this manifest gets one delayed retry
+                    first = prev_fail is None or prev_fail[0] != stat
+                    failed[name] = (stat, now + RETRY_DELAY if first else None)
+                    if name in old:
+                        modes[name] = old[name]
+
+            changed = modes.keys() != old.keys() or any(modes[n] is not old[n] for n in modes)
+            self._modes = modes
+            self.errors, self.pending = errors, pending
+            self._failed = failed
+            self._signature = signature
+            return changed
+
+    # --- watching ---
+    def start_watching(self, interval=2.0, on_change=None):
+        """Poll manifests in a daemon thread and hot-swap on change.
+
+        Threads do not survive fork, so under gunicorn call this per worker.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return self._watcher
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.reload() and on_change:
+                        on_change(self)
+                    if WATCHER_ERROR_KEY in self.errors:
+                        self.errors = {k: v for k, v in self.errors.items() if k != WATCHER_ERROR_KEY}
+                except Exception as e:
+                    # keep serving the last good snapshot, but surface the failure
+                    log.exception("Mode registry reload failed")
+                    self.errors = {**self.errors, WATCHER_ERROR_KEY: str(e)}
+
+        self._watcher = threading.Thread(target=_loop, name="mode-registry-watch", daemon=True)
+        self._watcher.start()
+        return self._watcher
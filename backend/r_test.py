@@ -7,7 +7,8 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Ellipse
-from scipy.stats import chi2
+
+from ellipses import fit_ellipses
 
 R_FILE = Path("prediction/1633_NMDS.R").resolve()
 CSV    = Path("prediction/data/train/240130-Paper1-present 1633 targets.csv").resolve()
@@ -29,22 +30,12 @@ if not m:
 payload = json.loads(m.group(0))
 
 # ---- helpers ----
-# 95% ellipse from mean/cov (bivariate normal)
+# 95% ellipses come from the shared batched engine (same math as the API)
 DARK2 = plt.get_cmap("Dark2")
 
-def confidence_ellipse(xy, ax, facecolor, alpha=0.25, zorder=1):
-    xy = np.asarray(xy)
-    if xy.shape[0] < 3: return
-    mu  = xy.mean(axis=0)
-    cov = np.cov(xy, rowvar=False)
-    vals, vecs = np.linalg.eigh(cov)
-    order = vals.argsort()[::-1]
-    vals, vecs = vals[order], vecs[:, order]
-    r2 = chi2.ppf(0.95, df=2)
-    w, h = 2*np.sqrt(vals*r2)
-    ang = np.degrees(np.arctan2(*vecs[:,0][::-1]))
-    ax.add_patch(Ellipse(mu, w, h, angle=ang, facecolor=facecolor, edgecolor='none',
-                         alpha=alpha, zorder=zorder))
+def confidence_ellipse(e, ax, facecolor, alpha=0.25, zorder=1):
+    ax.add_patch(Ellipse((e["cx"], e["cy"]), e["width"], e["height"], angle=e["angle"],
+                         facecolor=facecolor, edgecolor='none', alpha=alpha, zorder=zorder))
 
 def plot_nmds(scores_df, new_points, stress):
     # --- compute ranges incl. new points ---
@@ -64,10 +55,12 @@ def plot_nmds(scores_df, new_points, stress):
 
     # groups (Dark2 like ggplot)
     groups = sorted(scores_df["Group"].astype(str).unique())
+    ell = fit_ellipses(scores_df).params()
     for i, g in enumerate(groups):
         sub = scores_df[scores_df["Group"].astype(str) == g]
         color = DARK2(i % 8)
-        confidence_ellipse(sub[["NMDS1","NMDS2"]].values, ax, facecolor=color, alpha=0.25)
+        if g in ell:
+            confidence_ellipse(ell[g], ax, facecolor=color, alpha=0.25)
         ax.scatter(sub["NMDS1"], sub["NMDS2"], s=36, c=[color], alpha=0.95, label=g, zorder=2)
 
     # new points